@@ -4,8 +4,15 @@ import geopandas as gpd # type: ignore
 from pathlib import Path
 import re
 import numpy as np # type: ignore
+import numpy_groupies as npg # type: ignore
+import numba # type: ignore
+from numba import njit, prange # type: ignore
 import os
+import multiprocessing
 import argparse
+import dask # type: ignore
+from dask.delayed import Delayed # type: ignore
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Create the argument parser
 parser = argparse.ArgumentParser(description="Run flooding model standardization for multiple years.")
@@ -14,10 +21,9 @@ parser = argparse.ArgumentParser(description="Run flooding model standardization
 parser.add_argument("--cause", type=str, required=True, help="Cause: malaria or dengue")
 parser.add_argument("--scenario", type=int, required=True, help="RCP/SSP Scenarios: 0, 75, 76")
 parser.add_argument("--measure", type=str, required=True, help="Measure Counts: death or incidence")
-parser.add_argument("--draw", type=int, required=True, help="Draw number: 0-99")
-
-# Parse arguments
-args = parser.parse_args()
+parser.add_argument("--draws", type=str, required=True, help="Draw numbers, ranges and/or lists: 0-99 or 0,5,10-20")
+parser.add_argument("--n-workers", type=int, default=1, help="Number of draws raked in parallel")
+parser.add_argument("--write-batch-size", type=int, default=1, help="Draws each worker keeps in memory and writes together")
 
 # --------- Loading Helper Functions ------------------------------ #
 
@@ -25,12 +31,9 @@ args = parser.parse_args()
 # --------- Loading Helper Functions ------------------------------ #
 
 
-def impute_location_ids(ds: xr.Dataset, value_var: str = "value") -> xr.Dataset:
+def remap_imputed_location_ids(loc_ids: np.ndarray) -> np.ndarray:
     """
-    Fast version of impute_location_ids:
-    - Reassigns old location_ids to new ones.
-    - Sums values into the new_id only for the few cases in IMPUTE_MAP.
-    - Avoids groupby().sum(), which is a bottleneck.
+    Reassigns old location_ids to new ones in a single vectorized pass.
     """
     IMPUTE_MAP = {
         60908: 44858,
@@ -38,29 +41,62 @@ def impute_location_ids(ds: xr.Dataset, value_var: str = "value") -> xr.Dataset:
         94364: 44858,
     }
 
-    ds_copy = ds.copy()
+    old_ids = np.fromiter(IMPUTE_MAP.keys(), dtype=loc_ids.dtype)
+    new_ids = np.fromiter(IMPUTE_MAP.values(), dtype=loc_ids.dtype)
 
-    for old_id, new_id in IMPUTE_MAP.items():
-        if old_id in ds_copy.location_id.values:
-            # If the new_id already exists, add the old values into it
-            if new_id in ds_copy.location_id.values:
-                ds_copy[value_var].loc[dict(location_id=new_id)] += \
-                    ds_copy[value_var].loc[dict(location_id=old_id)]
-            else:
-                # If new_id does not exist, reassign the coordinate
-                ds_copy = ds_copy.assign_coords(
-                    location_id=xr.where(ds_copy.location_id == old_id,
-                                         new_id,
-                                         ds_copy.location_id)
-                )
-        # Drop the old_id entirely
-        if old_id in ds_copy.location_id.values:
-            ds_copy = ds_copy.drop_sel(location_id=old_id)
-
-    return ds_copy
+    # sort the lookup table so it can be searched
+    order = np.argsort(old_ids)
+    old_ids, new_ids = old_ids[order], new_ids[order]
+
+    is_old = np.isin(loc_ids, old_ids)
+    remapped_ids = loc_ids.copy()
+    remapped_ids[is_old] = new_ids[np.searchsorted(old_ids, loc_ids[is_old])]
+
+    return remapped_ids
+
+
+def impute_location_ids(ds: xr.Dataset, value_var: str = "value") -> xr.Dataset:
+    """
+    Fast version of impute_location_ids:
+    - Remaps old location_ids to new ones in a single vectorized pass.
+    - Sums duplicated location_ids with one numpy_groupies aggregate.
+    - Other variables along location_id keep one row per new id, the new id's own
+      row where it exists (as before), otherwise the first reassigned row.
+    - Avoids per-key .loc / drop_sel cycles and groupby().sum().
+    """
+    loc_ids = ds["location_id"].values
+    remapped_ids = remap_imputed_location_ids(loc_ids)
+    is_old = remapped_ids != loc_ids
+    if not is_old.any():
+        return ds
+
+    # Factorize remapped ids into group indices
+    unique_ids, group_idx = np.unique(remapped_ids, return_inverse=True)
+
+    # Row kept per group: sort by group, non-reassigned rows first, take each group's head
+    order = np.lexsort((np.arange(loc_ids.size), is_old, group_idx))
+    keep_idx = order[np.r_[0, np.flatnonzero(np.diff(group_idx[order])) + 1]]
+
+    # Collapse duplicated location_ids in a single aggregate pass
+    da = ds[value_var]
+    loc_axis = da.get_axis_num("location_id")
+    summed = npg.aggregate(
+        group_idx,
+        np.ascontiguousarray(da.values),
+        func="sum",
+        axis=loc_axis,
+        size=unique_ids.size,
+    )
+
+    return (
+        ds.drop_vars(value_var)
+        .isel(location_id=keep_idx)
+        .assign_coords(location_id=unique_ids)
+        .assign({value_var: (da.dims, summed, da.attrs)})
+    )
 
 # Extra Function to load all draws
-def load_draws(draw_folder_path):
+def load_draws(draw_folder_path: Path) -> xr.Dataset:
     datasets = []
     for i, f in enumerate(sorted(draw_folder_path.glob("*.nc"))):
         match = re.search(r"draw_(\d+)", f.name)
@@ -68,7 +104,7 @@ def load_draws(draw_folder_path):
             raise ValueError(f"Could not parse draw_id from {f.name}")
         draw_id = int(match.group(1))
 
-        ds = xr.open_dataset(f, chunks={})  # lazy load with dask
+        ds = xr.open_dataset(f, engine="h5netcdf", chunks={})  # lazy load with on-disk chunks
 
         # If the dataset already has a "draw" dimension, just use it
         if "draw" in ds.dims:
@@ -85,7 +121,33 @@ def load_draws(draw_folder_path):
 
 
 
-def get_forcasted_ds(cause: str, scenario: int, measure: str, draw: int) -> xr.Dataset:
+def parse_draws(draws: str) -> list[int]:
+    """
+    Parse a draw spec such as "0-99" or "0,5,10-20" into a list of draw numbers.
+    """
+    parsed = []
+    for part in draws.split(","):
+        start, _, stop = part.partition("-")
+        parsed.extend(range(int(start), int(stop or start) + 1))
+    return parsed
+
+
+def select_draw(ds: xr.Dataset, draw: int) -> xr.Dataset:
+    """
+    Select a single draw, keeping the draw dimension with length 1.
+    """
+    if "draw" in ds.dims:
+        return ds.sel(draw=[draw])
+
+    # draw is a non-dimension coordinate, select along its dimension
+    idx = int(np.where(ds["draw"].values == draw)[0][0])
+    return ds.isel({ds["draw"].dims[0]: [idx]})
+
+
+def get_forcasted_ds(cause: str, scenario: int, measure: str, draw: int | None = None) -> xr.Dataset:  # pragma: no cover, reads cluster paths
+    """
+    Forecasted admin 1 values. Returns all draws when draw is None.
+    """
     CAUSE_MAP = {
         "malaria": "malaria.nc",
         "dengue": "ntd_dengue.nc"
@@ -120,18 +182,24 @@ def get_forcasted_ds(cause: str, scenario: int, measure: str, draw: int) -> xr.D
     if not file_path.exists():
         raise FileNotFoundError(f"The file {file_path} does not exist.")
 
-    ds = xr.open_dataset(file_path)
+    # One dask chunk per draw so selecting a draw never loads the whole cube,
+    # other dims keep the on-disk HDF5 chunking
+    ds = xr.open_dataset(file_path, engine="h5netcdf", chunks={"draw": 1})
 
-    ds = ds.where(ds["draw"] == draw, drop=True)
+    if draw is not None:
+        ds = select_draw(ds, draw)
 
     if "draws" in ds.data_vars:
         ds = ds.rename_vars({"draws": "value"})
 
+    # cast to float32 on load, outputs are float32 and it halves the bytes moved downstream
+    ds["value"] = ds["value"].astype("float32", copy=False)
+
     return ds
 
 
 
-def get_predicted_ds(cause: str, scenario: int, measure: str, draw: int) -> xr.Dataset:
+def get_predicted_ds(cause: str, scenario: int, measure: str, draw: int) -> xr.Dataset:  # pragma: no cover, reads cluster paths
     """
     Predicted admin 2 values from Bobby.
     """
@@ -168,7 +236,7 @@ def get_predicted_ds(cause: str, scenario: int, measure: str, draw: int) -> xr.D
     
     # merge all draw nc files into a single ds
     filename = f"draw_{draw}.nc"
-    ds = xr.open_dataset(draw_folder_path / filename, chunks={})  # lazy load with dask
+    ds = xr.open_dataset(draw_folder_path / filename, engine="h5netcdf", chunks={})  # lazy load with on-disk chunks
 
     if "draw" not in ds.dims:
         ds = ds.expand_dims("draw")
@@ -181,30 +249,59 @@ def get_predicted_ds(cause: str, scenario: int, measure: str, draw: int) -> xr.D
     # rename data variable to value
     ds = ds.rename({"val": "value"})
 
-    # cast all coords to int64
-    for coord in ds.coords:
-        ds[coord] = ds[coord].astype("int64")
+    # float32, same as the admin 1 forecasts
+    ds["value"] = ds["value"].astype("float32", copy=False)
+
+    # cast all coords to int64 in a single assign
+    ds = ds.assign_coords({
+        coord: ds[coord].astype("int64", copy=False)
+        for coord in ds.coords
+        if ds[coord].dtype != np.int64
+    })
 
     return ds
 
-def load_in_hierarchy_dataset() -> None:
-    """
-    Loads full LSAE Hierarchy 2023 LSAE_1209
-    """
+HIERARCHY_FILE = Path("/mnt/team/rapidresponse/pub/malaria-denv/deliverables/2025_08_26_admin_2_counts/full_hierarchy_2023_lsae_1209.nc")
+HIERARCHY_CACHE = HIERARCHY_FILE.with_name("hierarchy_admin2.npz")
 
-    main_dir = Path("/mnt/team/rapidresponse/pub/malaria-denv/deliverables/2025_08_26_admin_2_counts/")
-    file_name = "full_hierarchy_2023_lsae_1209.nc"
 
-    ds = xr.open_dataset(main_dir / file_name)
+def build_hierarchy_cache() -> None:
+    """
+    One-shot preprocessor: writes the admin 2 location_id and parent_id arrays of the
+    LSAE Hierarchy 2023 LSAE_1209 to a small .npz next to the hierarchy file.
+    """
+    # No dask chunks: where(drop=True) needs the level mask in memory, and the file is small
+    ds = xr.open_dataset(HIERARCHY_FILE, engine="h5netcdf")
 
     # subset to admin 2
     ds = ds.where(ds["level"] == 5, drop=True)
 
-    for coord in ds.coords:
-        ds[coord] = ds[coord].astype("int64")
+    # Write to a temporary file first, so concurrent children never read a partial cache
+    tmpfile = HIERARCHY_CACHE.with_name(f".{HIERARCHY_CACHE.name}.{os.getpid()}.tmp")
+    with open(tmpfile, "wb") as f:
+        np.savez(
+            f,
+            location_id=ds["location_id"].values.astype("int64"),
+            parent_id=ds["parent_id"].values.astype("int64"),
+        )
+    os.replace(tmpfile, HIERARCHY_CACHE)
+
+def load_in_hierarchy_dataset() -> xr.Dataset:
+    """
+    Loads admin 2 location_id / parent_id from LSAE Hierarchy 2023 LSAE_1209.
+    Reads the .npz cache, building it first if missing or older than the hierarchy file.
+    """
+    if (
+        not HIERARCHY_CACHE.exists()
+        or HIERARCHY_CACHE.stat().st_mtime < HIERARCHY_FILE.stat().st_mtime
+    ):
+        build_hierarchy_cache()
+
+    with np.load(HIERARCHY_CACHE) as data:
+        location_id = data["location_id"]
+        parent_id = data["parent_id"]
 
-    # change parentId to int64
-    ds["parent_id"] = ds["parent_id"].astype("int64")
+    ds = xr.Dataset(coords={"location_id": location_id, "parent_id": ("location_id", parent_id)})
 
     return ds
 
@@ -214,8 +311,8 @@ def subset_admin1_to_admin2_dims(ds_admin1: xr.Dataset, ds_admin2: xr.Dataset) -
     This ensures alignment for raking calculations.
     """
     # Determine intersecting age_group_id and sex_id
-    age_ids = [a for a in ds_admin1.age_group_id.values if a in ds_admin2.age_group_id.values]
-    sex_ids = [s for s in ds_admin1.sex_id.values if s in ds_admin2.sex_id.values]
+    age_ids = ds_admin1.age_group_id.values[np.isin(ds_admin1.age_group_id.values, ds_admin2.age_group_id.values)]
+    sex_ids = ds_admin1.sex_id.values[np.isin(ds_admin1.sex_id.values, ds_admin2.sex_id.values)]
 
     # Subset ds_admin1
     ds_admin1_subset = ds_admin1.sel(age_group_id=age_ids, sex_id=sex_ids)
@@ -225,136 +322,115 @@ def subset_admin1_to_admin2_dims(ds_admin1: xr.Dataset, ds_admin2: xr.Dataset) -
 
 # ---------- Main Helper Functions ---------------------------------#
 
-def subset_ds_to_admin2_locations(hierarchy_ds: xr.Dataset, ds: xr.Dataset) -> xr.Dataset:
+def prepare_raking_layout(
+    hierarchy_ds: xr.Dataset,
+    admin2_location_ids: np.ndarray,
+    admin1_location_ids: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
-    Subset dataset to only the intersection of location_ids in the hierarchy_ds
-    and location_ids in the dataset.
-    Drops unmatched IDs from both ends.
+    Work out which admin2 locations are raked and onto which admin1 parent.
+    Location membership does not change between draws, so this runs once per batch.
+
+    Returns:
+      parent_idx: position of each raked admin2 location's parent in parent_ids
+      parent_ids: admin1 location_ids that are parents of admin2 locations (sorted)
+      raked_location_ids: admin2 location_ids with a parent in admin1
+      unraked_location_ids: admin2 location_ids without a parent in admin1
     """
-    admin2_ids = set(hierarchy_ds.location_id.values)
-    ds_ids = set(ds.location_id.values)
+    # Keep only admin2 locations present in the hierarchy, and look up their parents
+    location_ids = np.intersect1d(hierarchy_ds["location_id"].values, admin2_location_ids)
+    parent_ids = hierarchy_ds["parent_id"].sel(location_id=location_ids).values
 
-    # Intersection only
-    common_ids = sorted(admin2_ids & ds_ids)
+    # Split into admin2 locations with and without parent_id in admin1
+    has_parent = np.isin(parent_ids, admin1_location_ids)
+    parent_ids, parent_idx = np.unique(parent_ids[has_parent], return_inverse=True)
 
-    return ds.sel(location_id=common_ids, drop=True)
+    return parent_idx, parent_ids, location_ids[has_parent], location_ids[~has_parent]
 
 
-def attach_hierarchy(ds: xr.Dataset, hierarchy_ds: xr.Dataset) -> xr.Dataset:
-    """
-    Attach hierarchy information to the admin2 predictions using the full hierarchy dataset.
-    Keeps only location_ids present in both ds and hierarchy_ds.
-    Retains all hierarchy metadata (parent_id, names, etc.).
+def check_layout_locations(
+    ds_admin2: xr.Dataset,
+    hierarchy_ds: xr.Dataset,
+    layout: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+) -> None:
     """
-
-    # --- Step 0: restrict to common IDs --- #
-    common_ids = sorted(set(ds.location_id.values) & set(hierarchy_ds.location_id.values))
-    ds_admin2 = ds.sel(location_id=common_ids, drop=True)
-    hierarchy_sub = hierarchy_ds.sel(location_id=common_ids, drop=True)
-
-    # --- Step 1: merge hierarchy metadata into ds --- #
-    # This will preserve all variables from hierarchy_ds (parent_id, names, etc.)
-    ds_admin2 = xr.merge([ds_admin2, hierarchy_sub])
-
-    return ds_admin2
-
-def split_ds_admin1(ds_admin2: xr.Dataset, ds_admin1: xr.Dataset) -> tuple[xr.Dataset, xr.Dataset]:
+    Check that a draw's admin 2 locations are the ones a shared layout was built from.
+    Raises a ValueError otherwise, instead of silently dropping or failing on locations.
     """
-    Split admin1 dataset into:
-      1. locations that correspond to parent_ids in ds_admin2
-      2. locations that do not correspond to parent_ids in ds_admin2
+    _, _, raked_location_ids, unraked_location_ids = layout
 
-    Uses direct indexing for speed.
-    """
-    # Identify parent_ids in admin2 that exist in admin1 location_id
-    common_ids = list(set(ds_admin2["parent_id"].values) & set(ds_admin1["location_id"].values))
-    
-    # Directly select with .sel() for fast indexing
-    ds_admin1_with_parent_id = ds_admin1.sel(location_id=common_ids)
-    
-    # Select remaining locations using difference
-    remaining_ids = list(set(ds_admin1["location_id"].values) - set(common_ids))
-    ds_admin1_without_parent_id = ds_admin1.sel(location_id=remaining_ids)
+    draw_location_ids = np.intersect1d(ds_admin2["location_id"].values, hierarchy_ds["location_id"].values)
+    layout_location_ids = np.union1d(raked_location_ids, unraked_location_ids)
 
-    return ds_admin1_with_parent_id, ds_admin1_without_parent_id
+    if not np.array_equal(draw_location_ids, layout_location_ids):
+        missing = np.setdiff1d(layout_location_ids, draw_location_ids)
+        extra = np.setdiff1d(draw_location_ids, layout_location_ids)
+        raise ValueError(
+            "Admin 2 location_ids differ from the raking layout: "
+            f"missing {missing.tolist()}, not in layout {extra.tolist()}"
+        )
 
 
-def split_ds_admin2(ds_admin2: xr.Dataset, ds_admin1: xr.Dataset) -> tuple[xr.Dataset, xr.Dataset]:
+@njit(parallel=True, cache=True)
+def _rake_kernel(  # pragma: no cover, compiled by numba so coverage cannot trace it
+    values: np.ndarray, parent_idx: np.ndarray, admin1: np.ndarray, out: np.ndarray
+) -> None:
     """
-    Split admin 2 dataset into admin 2 units with parent ids in admin 1 dataset and not.
+    Rake admin2 values (n_rest, n_loc) to admin1 totals (n_rest, n_parents) slab by slab:
+    per-parent sums first, then each admin2 value times admin1 / sum (1.0 where either is zero).
     """
+    n_rest, n_loc = values.shape
+    n_parents = admin1.shape[1]
+    for j in prange(n_rest):
+        # Sum admin2 values per parent, skipping NaNs like groupby().sum()
+        sums = np.zeros(n_parents, dtype=np.float64)
+        for i in range(n_loc):
+            v = values[j, i]
+            if not np.isnan(v):
+                sums[parent_idx[i]] += v
+
+        # Multiply each admin2 value by its parent's factor
+        for i in range(n_loc):
+            p = parent_idx[i]
+            a1 = admin1[j, p]
+            a2 = sums[p]
+            if a1 == 0 or a2 == 0:
+                out[j, i] = values[j, i]
+            else:
+                out[j, i] = values[j, i] * (a1 / a2)
 
-    common_ids = np.array(list(set(ds_admin2["parent_id"].values) & set(ds_admin1["location_id"].values)))
-    mask = ds_admin2["parent_id"].isin(common_ids)
-
-    # Keep rows where parent_id is in ds_admin1
-    ds_admin2_with_parent = ds_admin2.where(mask, drop=True)
-
-    # Keep rows where parent_id is not in ds_admin1
-    ds_admin2_without_parent = ds_admin2.where(~mask, drop=True)
-
-
-    return ds_admin2_with_parent, ds_admin2_without_parent
 
-def sum_and_align_admin2_totals(
+def rake_admin2_to_admin1(
     ds_admin2: xr.Dataset,
     ds_admin1: xr.Dataset,
-    value_var: str = "value"
-) -> xr.DataArray:
-    # Ensure parent_id is coordinate
-    if "parent_id" not in ds_admin2.coords:
-        ds_admin2 = ds_admin2.assign_coords(parent_id=ds_admin2["parent_id"])
-
-    # Sum only over location_id
-    admin2_sums = ds_admin2[value_var].groupby("parent_id").sum(dim="location_id")
-    admin2_sums = admin2_sums.rename({"parent_id": "location_id"})
-
-    # Keep admin1 location_id coordinate
-    admin1_ids = ds_admin1["location_id"].values
-
-    # Reindex admin2_sums to match admin1
-    admin2_sums_aligned = admin2_sums.reindex(location_id=admin1_ids)
-
-    factor = xr.where(
-        (admin2_sums_aligned == 0) | (ds_admin1 == 0),
-        1.0,
-        ds_admin1 / xr.where(admin2_sums_aligned == 0, 1, admin2_sums_aligned)
-    )
-
-    return factor
-
-
-
-
-def broadcast_factor_to_admin2(
-    ds_admin2: xr.Dataset,
-    factor: xr.Dataset,
+    parent_idx: np.ndarray,
     value_var: str = "value"
 ) -> xr.DataArray:
     """
-    Broadcast raking factors (per parent_id/admin1) to admin2 units.
-    Uses xarray broadcasting and alignment, so it's memory-efficient with dask.
+    Rake admin2 values to their admin1 parent totals, where parent_idx gives the
+    position of each admin2 location's parent along ds_admin1's location_id.
+    Sums, factors and the broadcast multiply run in one fused compiled kernel,
+    without materializing the sums or the factor as full-size arrays.
     """
 
-    # Ensure parent_id is a coordinate
-    if "parent_id" not in ds_admin2.coords:
-        ds_admin2 = ds_admin2.assign_coords(parent_id=ds_admin2["parent_id"])
-
-    # Extract factor DataArray
-    if isinstance(factor, xr.Dataset):
-        var_name = list(factor.data_vars)[0]
-        factor_da = factor[var_name]
-    else:
-        factor_da = factor
-
-    # Rename factor dimension for alignment
-    factor_da = factor_da.rename({"location_id": "parent_id"})
-
-    # Align factor to admin2 parent_id
-    factor_broadcasted = factor_da.sel(parent_id=ds_admin2["parent_id"])
+    # Align all dims except location_id, with location_id last so each slab is contiguous
+    da_admin2 = ds_admin2[value_var].transpose(..., "location_id")
+    da_admin2, da_admin1 = xr.align(da_admin2, ds_admin1[value_var], join="inner", exclude=["location_id"])
+    da_admin1 = da_admin1.transpose(*da_admin2.dims)
+
+    vals_admin2 = np.ascontiguousarray(da_admin2.values)
+    vals_admin1 = np.ascontiguousarray(da_admin1.values)
+    out = np.empty(vals_admin2.shape, dtype=vals_admin2.dtype)
+    _rake_kernel(
+        vals_admin2.reshape(-1, vals_admin2.shape[-1]),
+        parent_idx,
+        vals_admin1.reshape(-1, vals_admin1.shape[-1]),
+        out.reshape(-1, out.shape[-1]),
+    )
 
-    # Multiply by admin2 values
-    raked_values = ds_admin2[value_var] * factor_broadcasted
+    # Back to the input dim order
+    raked_values = xr.DataArray(out, dims=da_admin2.dims, coords=da_admin2.coords)
+    raked_values = raked_values.transpose(*ds_admin2[value_var].dims)
 
     return raked_values
 
@@ -366,38 +442,55 @@ def build_raked_dataset(ds_admin2: xr.Dataset, raked_values: xr.DataArray, value
 
     """
 
-    # Ensure parent_id is a coordinate
-    if "parent_id" not in ds_admin2.coords:
-        ds_admin2 = ds_admin2.assign_coords(parent_id=ds_admin2["parent_id"])
-        
-    # --- Step 6: build final dataset ---
-    ds_admin2_raked = ds_admin2.copy()
-    ds_admin2_raked[value_var] = raked_values
-
-    # assign parent_id as data variable
-    ds_admin2_raked = ds_admin2_raked.reset_coords("parent_id", drop=False)
+    # --- build final dataset ---
+    # assign returns a shallow copy, other variables are shared rather than deep-copied
+    ds_admin2_raked = ds_admin2.assign({value_var: raked_values})
 
     return ds_admin2_raked
 
-def merge_raked_and_unraked_admin2_dask(
+def merge_raked_and_unraked_admin2(
     raked_ds: xr.Dataset, ds_admin2_without_parent: xr.Dataset
 ) -> xr.Dataset:
     """
-    Merge raked and unraked admin2 datasets efficiently using dask.
-    
+    Merge raked and unraked admin2 datasets into pre-allocated numpy buffers.
+
     Assumes:
-    - Both datasets are dask-backed.
-    - Only 'location_id' differs; all other coordinates are identical.
+    - Only 'location_id' differs; all other coordinates are shared.
     - location_id values are disjoint.
     """
-    # Ensure both datasets are dask-backed
-    if not raked_ds.chunks:
-        raked_ds = raked_ds.chunk()
-    if not ds_admin2_without_parent.chunks:
-        ds_admin2_without_parent = ds_admin2_without_parent.chunk()
+    # Match the non-location coordinate order of the raked dataset
+    ds_admin2_without_parent = ds_admin2_without_parent.reindex(
+        {dim: raked_ds.indexes[dim] for dim in raked_ds.indexes if dim != "location_id"}
+    )
+
+    n_with = raked_ds.sizes["location_id"]
+    n_without = ds_admin2_without_parent.sizes["location_id"]
+    location_ids = np.concatenate(
+        [raked_ds["location_id"].values, ds_admin2_without_parent["location_id"].values]
+    )
+
+    data_vars = {}
+    for var, da in raked_ds.data_vars.items():
+        if "location_id" not in da.dims:
+            data_vars[var] = da
+            continue
+
+        # Keep the variable's dim order, so outputs keep the admin 1 layout
+        other = ds_admin2_without_parent[var].transpose(*da.dims)
+        loc_axis = da.get_axis_num("location_id")
+        shape = da.shape[:loc_axis] + (n_with + n_without,) + da.shape[loc_axis + 1:]
+        vals = np.empty(shape, dtype=np.result_type(da.dtype, other.dtype))
 
-    # Concatenate along location_id (lazy dask operation)
-    merged_ds = xr.concat([raked_ds, ds_admin2_without_parent], dim="location_id")
+        # Write each piece into its slice of the output buffer, through a location-first view
+        vals_by_location = np.moveaxis(vals, loc_axis, 0)
+        vals_by_location[:n_with] = np.moveaxis(da.values, loc_axis, 0)
+        vals_by_location[n_with:] = np.moveaxis(other.values, loc_axis, 0)
+        data_vars[var] = (da.dims, vals, da.attrs)
+
+    coords = {name: coord for name, coord in raked_ds.coords.items() if "location_id" not in coord.dims}
+    coords["location_id"] = location_ids
+
+    merged_ds = xr.Dataset(data_vars, coords=coords, attrs=raked_ds.attrs)
 
     return merged_ds
 
@@ -411,16 +504,12 @@ def drop_data_variables(merged_ds: xr.Dataset) -> xr.Dataset:
 
 
 
-def save_raked_dataset_optimized(
-    cause: str,
-    scenario: int,
-    measure: str,
-    draw: int,
-    merged_ds: xr.Dataset,
-) -> None:
+OUTPUT_DIR = Path("/mnt/team/rapidresponse/pub/malaria-denv/deliverables/2025_08_26_admin_2_counts/output/")
+
+
+def get_output_path(cause: str, scenario: int, measure: str, draw: int) -> Path:
     """
-    Save the raked admin2 dataset to NetCDF with faster I/O.
-    Optimized for large, merged datasets.
+    Path of the raked admin 2 output for one draw.
     """
     SCENARIO_MAP = {0: "ssp245", 75: "ssp126", 76: "ssp585"}
     MEASURE_MAP = {"death": "mortality", "incidence": "incidence", "yll" : "yll", "yld": "yld"}
@@ -428,12 +517,6 @@ def save_raked_dataset_optimized(
     scenario_name = SCENARIO_MAP[scenario]
     measure_name = MEASURE_MAP[measure]
 
-    # --- Output directory ---
-    out_dir = Path("/mnt/team/rapidresponse/pub/malaria-denv/deliverables/2025_08_26_admin_2_counts/output/")
-    out_dir.mkdir(parents=True, exist_ok=True)
-    out_dir.chmod(0o775)
-
-    # --- Build subdir ---
     if cause == "malaria":
         dirname = (
             f"as_cause_{cause}_measure_{measure_name}_metric_count_"
@@ -444,95 +527,279 @@ def save_raked_dataset_optimized(
             f"as_cause_{cause}_measure_{measure_name}_metric_count_"
             f"ssp_scenario_{scenario_name}_raked"
         )
-    out_dir = out_dir / dirname
-    out_dir.mkdir(parents=True, exist_ok=True)
 
-    # --- Filename ---
-    outfile = out_dir / f"draw_{int(draw)}.nc"
+    return OUTPUT_DIR / dirname / f"draw_{int(draw)}.nc"
+
+
+def save_raked_dataset_optimized(
+    cause: str,
+    scenario: int,
+    measure: str,
+    draw: int,
+    merged_ds: xr.Dataset,
+    delayed: bool = False,
+) -> Delayed | None:
+    """
+    Save the raked admin2 dataset to NetCDF with faster I/O.
+    Optimized for large, merged datasets.
+    With delayed=True nothing is written yet, the returned dask.delayed performs the write.
+    """
+    outfile = get_output_path(cause, scenario, measure, draw)
+
+    # --- Output directory ---
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    OUTPUT_DIR.chmod(0o775)
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary name first, so a partial file never looks like a finished draw
+    tmpfile = outfile.with_name(f".{outfile.name}.tmp")
 
     # --- Encoding ---
-    # Use faster compression (or none, if speed > size matters)
+    # No filters and no chunking, so HDF5 stores each variable contiguously
     encoding = {
         var: {
-            "zlib": True,
-            "complevel": 0,
+            "zlib": False,
             "dtype": "float32",
-            "chunksizes": tuple(s[0] for s in merged_ds[var].chunks),  
         }
         for var in merged_ds.data_vars
     }
     # --- Save ---
+    if delayed:
+        # numpy-backed variables are written eagerly by to_netcdf, wrap them in dask to defer
+        merged_ds = merged_ds.chunk()
+
     # h5netcdf engine is much faster than netcdf4 for large outputs
-    merged_ds.to_netcdf(
-        outfile,
+    write = merged_ds.to_netcdf(
+        tmpfile,
+        format="NETCDF4",
         engine="h5netcdf",
         encoding=encoding,
-        compute=True,
+        compute=not delayed,
     )
-    
+
+    if delayed:
+        return dask.delayed(_finalize_output)(write, tmpfile, outfile)
+
+    _finalize_output(None, tmpfile, outfile)
+    return None
+
+
+def _finalize_output(write: None, tmpfile: Path, outfile: Path) -> None:
+    """
+    Move a finished write into place and fix its permissions.
+    Takes the write as an argument only so it runs after the write in a dask graph.
+    """
+    os.replace(tmpfile, outfile)
+
     # --- Fix permissions ---
     os.chmod(outfile, 0o775)
 
     print(f"[✓] Saved: {outfile}")
 
+def rake_draw(
+    ds_admin2: xr.Dataset,
+    ds_admin1: xr.Dataset,
+    layout: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    value_var: str = "value"
+) -> xr.Dataset:
+    """
+    Rake one draw of admin 2 predictions to admin 1 using a precomputed layout
+    from prepare_raking_layout.
+    """
+    parent_idx, parent_ids, raked_location_ids, unraked_location_ids = layout
+
+    # Select admin2 with and without parent_id in admin1, and the matching admin1 parents
+    ds_admin2_with_parent = ds_admin2.sel(location_id=raked_location_ids)
+    ds_admin2_without_parent = ds_admin2.sel(location_id=unraked_location_ids)
+    ds_admin1_with_parent = ds_admin1.sel(location_id=parent_ids)
+
+    # Rake admin2 values to admin1 totals (sum, factor and broadcast in one kernel)
+    raked_values = rake_admin2_to_admin1(ds_admin2_with_parent, ds_admin1_with_parent, parent_idx, value_var)
+
+    # Build final raked dataset
+    ds_admin2_raked = build_raked_dataset(ds_admin2_with_parent, raked_values, value_var)
+
+    # Remerge raked admin 2 and the original admin 2 without parent id
+    merged_ds = merge_raked_and_unraked_admin2(ds_admin2_raked, ds_admin2_without_parent)
+
+    # Drop data variables
+    return drop_data_variables(merged_ds)
+
+
 def main_raking_function(
     cause: str,
     scenario: int,
     measure: str,
     draw: int,
-    value_var: str = "value"
+    value_var: str = "value",
+    *,
+    shared_admin1: xr.Dataset | None = None,
+    hierarchy_ds: xr.Dataset | None = None,
+    layout: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None,
+    save: bool = True,
 ) -> xr.Dataset:
     """
     Main function to rake admin 2 predictions to admin 1.
+    Reuses shared_admin1 (all draws), hierarchy_ds and the prepare_raking_layout layout when given.
+    With save=False the raked dataset is only returned, not written.
     """
 
     # Step 1: Load and prepare data inputs
-    ds_admin1 = get_forcasted_ds(cause, scenario, measure, draw)
+    if shared_admin1 is None:
+        ds_admin1 = get_forcasted_ds(cause, scenario, measure, draw)
+    else:
+        ds_admin1 = select_draw(shared_admin1, draw)
     ds_admin2 = get_predicted_ds(cause, scenario, measure, draw)
     ds_admin2 = impute_location_ids(ds_admin2, value_var=value_var)
     ds_admin2 = ds_admin2.transpose(*ds_admin1.dims)
 
-    hierarchy = load_in_hierarchy_dataset()
-
     # Step 2: Ensure ds_admin1 has the same coordinates as ds_admin2 in terms of age and sex
     ds_admin1 = subset_admin1_to_admin2_dims(ds_admin1, ds_admin2)
 
-    # Step 3: Ensure only admin 2 locations are present
-    ds_admin2 = subset_ds_to_admin2_locations(hierarchy, ds_admin2)
-
-    # Step 4: Attach hierarchy information
-    ds_admin2 = attach_hierarchy(ds_admin2, hierarchy)
-
-    # Step 5: Split datasets into those with and without parent_id in admin1
-    ds_admin2_with_parent, ds_admin2_without_parent = split_ds_admin2(ds_admin2, ds_admin1)
-    ds_admin1_with_parent, _ = split_ds_admin1(ds_admin2, ds_admin1)
-
-    # Step 6: Sum and align admin2 totals with admin1 totals
-    factor = sum_and_align_admin2_totals(ds_admin2_with_parent, ds_admin1_with_parent, value_var)
-
-    # Step 7: Broadcast factor to admin2 dataset
-    raked_values = broadcast_factor_to_admin2(ds_admin2_with_parent, factor, value_var)
+    # Step 3: Match admin 2 locations to their admin 1 parents
+    if hierarchy_ds is None:
+        hierarchy_ds = load_in_hierarchy_dataset()
+    if layout is None:
+        layout = prepare_raking_layout(
+            hierarchy_ds,
+            ds_admin2["location_id"].values,
+            ds_admin1["location_id"].values,
+        )
+    else:
+        # A shared layout assumes location membership does not change between draws
+        check_layout_locations(ds_admin2, hierarchy_ds, layout)
 
-    # Step 8: Build final raked dataset
-    ds_admin2_raked = build_raked_dataset(ds_admin2_with_parent, raked_values, value_var)
+    # Step 4: Rake admin 2 to admin 1 and merge with the unraked admin 2
+    merged_ds = rake_draw(ds_admin2, ds_admin1, layout, value_var)
 
-    # Step 9: Remerge raked admin 2 and the original admin 2 without parent id
-    merged_ds = merge_raked_and_unraked_admin2_dask(ds_admin2_raked, ds_admin2_without_parent)
+    # Step 5: Save output
+    if save:
+        save_raked_dataset_optimized(cause, scenario, measure, draw, merged_ds)
 
-    # Step 10: Drop data variables
-    merged_ds = drop_data_variables(merged_ds)
+    return merged_ds
 
-    # Step 11: Save output
-    save_raked_dataset_optimized(cause, scenario, measure, draw, merged_ds)
 
-    return merged_ds
+def _init_worker(n_threads: int) -> None:
+    """
+    Process pool initializer: cap numba's threads so n_workers pool processes
+    together use the allocated cores instead of one thread per CPU each.
+    """
+    numba.set_num_threads(n_threads)
 
 
-# Call the function with parsed arguments
-main_raking_function(
-    cause=args.cause,
-    scenario=args.scenario,
-    measure=args.measure,
-    draw=args.draw,
-    value_var="value"
+def _rake_draw_batch(
+    cause: str,
+    scenario: int,
+    measure: str,
+    draws: list[int],
+    value_var: str,
+    shared_admin1: xr.Dataset,
+    hierarchy_ds: xr.Dataset,
+    layout: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+) -> list[int]:
+    """
+    Process pool entry point for a batch of draws. Rakes each draw, then writes the
+    batch on a thread pool (a single draw is written directly). Returns the draw
+    numbers only, so the raked datasets are not pickled back to the parent process.
+    """
+    defer_writes = len(draws) > 1
+    writes = []
+
+    # The pool provides the parallelism, keep dask single threaded while raking
+    with dask.config.set(scheduler="synchronous"):
+        for draw in draws:
+            merged_ds = main_raking_function(
+                cause,
+                scenario,
+                measure,
+                draw,
+                value_var,
+                shared_admin1=shared_admin1,
+                hierarchy_ds=hierarchy_ds,
+                layout=layout,
+                save=False,
+            )
+            writes.append(
+                save_raked_dataset_optimized(cause, scenario, measure, draw, merged_ds, delayed=defer_writes)
+            )
+
+    if defer_writes:
+        dask.compute(*writes, scheduler="threads", num_workers=min(4, len(writes)))
+
+    return draws
+
+
+def rake_draws(  # pragma: no cover, runs draws in spawned processes
+    cause: str,
+    scenario: int,
+    measure: str,
+    draws: list[int],
+    n_workers: int = 1,
+    value_var: str = "value",
+    write_batch_size: int = 1
+) -> None:
+    """
+    Rake a batch of draws for one cause/scenario/measure.
+    The admin 1 forecasts and the raking layout are loaded once and shared across draws.
+    Each worker rakes write_batch_size draws at a time and writes them together,
+    so peak memory per worker grows with write_batch_size.
+    """
+    # Skip draws that already have an output, so a retried task only redoes the missing ones
+    draws = [draw for draw in draws if not get_output_path(cause, scenario, measure, draw).exists()]
+    if not draws:
+        print("[✓] All draws already raked")
+        return
+
+    ds_admin1 = get_forcasted_ds(cause, scenario, measure)
+
+    # location_id membership is draw-invariant (checked per draw), so match admin 2 to admin 1 parents once
+    admin2_location_ids = get_predicted_ds(cause, scenario, measure, draws[0])["location_id"].values
+    hierarchy_ds = load_in_hierarchy_dataset()
+    layout = prepare_raking_layout(
+        hierarchy_ds,
+        remap_imputed_location_ids(admin2_location_ids),
+        ds_admin1["location_id"].values,
     )
+
+    batches = [draws[i:i + write_batch_size] for i in range(0, len(draws), write_batch_size)]
+
+    # spawn, not fork: the parent already holds HDF5 handles, which are not fork-safe
+    n_threads = max(1, len(os.sched_getaffinity(0)) // n_workers)
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(n_threads,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                _rake_draw_batch,
+                cause,
+                scenario,
+                measure,
+                batch,
+                value_var,
+                ds_admin1,
+                hierarchy_ds,
+                layout,
+            )
+            for batch in batches
+        ]
+        for future in as_completed(futures):
+            print(f"[✓] Finished draws {future.result()}")
+
+
+if __name__ == "__main__":
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Call the function with parsed arguments
+    rake_draws(
+        cause=args.cause,
+        scenario=args.scenario,
+        measure=args.measure,
+        draws=parse_draws(args.draws),
+        n_workers=args.n_workers,
+        value_var="value",
+        write_batch_size=args.write_batch_size
+        )
@@ -1,8 +1,8 @@
 import getpass
+import os
 import uuid
+from functools import lru_cache
 import pandas as pd # type: ignore
-from jobmon.client.status_commands import workflow_tasks, task_status # type: ignore
-from jobmon.client.tool import Tool # type: ignore
 from pathlib import Path
 
 CAUSES = ["malaria", "dengue"]
@@ -10,80 +10,17 @@ SCENARIOS = [0, 75, 76]
 MEASURES = ["death", "incidence", "yll", "yld"]
 DRAWS = [i for i in range(100)]
 
-# Jobmon setup
-user = getpass.getuser()
-
-log_dir = Path(f"/mnt/share/scratch/users/mfiking/error")
-log_dir.mkdir(parents=True, exist_ok=True)
-# Create directories for stdout and stderr
-stdout_dir = log_dir / "stdout"
-stderr_dir = log_dir / "stderr"
-stdout_dir.mkdir(parents=True, exist_ok=True)
-stderr_dir.mkdir(parents=True, exist_ok=True)
-
-# Project
-project = "proj_rapidresponse"  # Adjust this to your project name if needed
-
-# create jobmon jobs
-user = getpass.getuser()
-wf_uuid = uuid.uuid4()
-
-# Create a tool
-tool = Tool(name="malaria_dengue_raking")
-
-
-# Create a workflow, and set the executor
-workflow = tool.create_workflow(
-    name=f"malaria_dengue_raking_{wf_uuid}",
-)
-
-# # Set resources on the workflow
-# workflow.set_default_compute_resources_from_dict(
-#     cluster_name="slurm",
-#     dictionary={
-#         "memory": "3G",
-#         "cores": 1,
-#         "runtime": "5m",
-#         "constraints": "archive",
-#         "queue": "all.q",
-#         "project": project,  # Ensure the project is set correctly
-#         "stdout": str(stdout_dir),
-#         "stderr": str(stderr_dir),
-#     }
-# )
-
-
-# Define the task template for processing each year batch
-task_template = tool.get_task_template(
-    template_name="malaria_dengue_raking_task",
-    default_cluster_name="slurm",
-    default_compute_resources={
-        "queue": "all.q",
-        "cores": int(1),
-        "memory": "3G",
-        "runtime": "5m",
-        "queue": "all.q",
-        "project": project,  # Ensure the project is set correctly
-        "stdout": str(stdout_dir),
-        "stderr": str(stderr_dir),
-    },
-    command_template=(
-        "python "
-        "/mnt/share/homes/mfiking/github_repos/malaria_dengv/src/malaria_dengv/raking/raking_child.py "
-        "--cause {cause} "
-        "--scenario {scenario} "
-        "--measure {measure} "
-        "--draw {draw}"
-    ),
-    node_args=["cause", "scenario", "measure", "draw"],  # 👈 Include years in node_args
-    task_args=[],  # Only variant is task-specific
-    op_args=[],
-)
-
-
-def check_if_path_draw_exists(cause, scenario, measure, draw):
-    out_dir = Path("/mnt/team/rapidresponse/pub/malaria-denv/deliverables/2025_08_26_admin_2_counts/output/")
+# Draws raked in parallel within each cause/scenario/measure task
+N_WORKERS = 8
 
+# Draws each worker holds in memory before writing them together
+WRITE_BATCH_SIZE = 1
+
+
+OUTPUT_DIR = Path("/mnt/team/rapidresponse/pub/malaria-denv/deliverables/2025_08_26_admin_2_counts/output/")
+
+
+def check_if_path_draw_exists(cause: str, scenario: int, measure: str, draw: int) -> bool:
     SCENARIO_MAP = {
         0: "ssp245",
         75: "ssp126",
@@ -105,45 +42,164 @@ def check_if_path_draw_exists(cause, scenario, measure, draw):
         )
     filename = f"draw_{int(draw)}.nc"
 
-    output_name = out_dir / dirname / filename
+    return filename in list_existing_outputs(OUTPUT_DIR / dirname)
+
+
+@lru_cache(maxsize=None)
+def list_existing_outputs(output_dir: Path) -> frozenset[str]:
+    """
+    List the file names in an output directory once, instead of one stat() per draw.
+    """
+    if not output_dir.exists():
+        return frozenset()
+    with os.scandir(output_dir) as entries:
+        return frozenset(entry.name for entry in entries if entry.is_file())
+
+
+def format_draws(draws: list[int]) -> str:
+    """
+    Collapse a sorted list of draws into a spec such as "0-49,51-99".
+    """
+    ranges = []
+    start = prev = draws[0]
+    for draw in draws[1:]:
+        if draw != prev + 1:
+            ranges.append(f"{start}-{prev}" if start != prev else f"{start}")
+            start = draw
+        prev = draw
+    ranges.append(f"{start}-{prev}" if start != prev else f"{start}")
+    return ",".join(ranges)
+
+
+def main() -> None:  # pragma: no cover, builds and runs the Jobmon workflow
+    # jobmon is only available on the cluster, import it here so the helpers above
+    # can be imported without it
+    from jobmon.client.status_commands import workflow_tasks, task_status # type: ignore
+    from jobmon.client.tool import Tool # type: ignore
+
+    # Jobmon setup
+    user = getpass.getuser()
+
+    log_dir = Path(f"/mnt/share/scratch/users/mfiking/error")
+    log_dir.mkdir(parents=True, exist_ok=True)
+    # Create directories for stdout and stderr
+    stdout_dir = log_dir / "stdout"
+    stderr_dir = log_dir / "stderr"
+    stdout_dir.mkdir(parents=True, exist_ok=True)
+    stderr_dir.mkdir(parents=True, exist_ok=True)
+
+    # Shared numba cache, so the raking kernel is compiled once for the whole workflow
+    numba_cache_dir = Path(f"/mnt/share/scratch/users/mfiking/numba_cache")
+    numba_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # Project
+    project = "proj_rapidresponse"  # Adjust this to your project name if needed
+
+    # create jobmon jobs
+    user = getpass.getuser()
+    wf_uuid = uuid.uuid4()
+
+    # Create a tool
+    tool = Tool(name="malaria_dengue_raking")
+
+
+    # Create a workflow, and set the executor
+    workflow = tool.create_workflow(
+        name=f"malaria_dengue_raking_{wf_uuid}",
+    )
+
+    # # Set resources on the workflow
+    # workflow.set_default_compute_resources_from_dict(
+    #     cluster_name="slurm",
+    #     dictionary={
+    #         "memory": "3G",
+    #         "cores": 1,
+    #         "runtime": "5m",
+    #         "constraints": "archive",
+    #         "queue": "all.q",
+    #         "project": project,  # Ensure the project is set correctly
+    #         "stdout": str(stdout_dir),
+    #         "stderr": str(stderr_dir),
+    #     }
+    # )
+
+
+    # Define the task template for processing each year batch
+    task_template = tool.get_task_template(
+        template_name="malaria_dengue_raking_task",
+        default_cluster_name="slurm",
+        default_compute_resources={
+            "queue": "all.q",
+            "cores": int(N_WORKERS),
+            "memory": f"{3 * N_WORKERS * WRITE_BATCH_SIZE}G",
+            "runtime": "90m",
+            "queue": "all.q",
+            "project": project,  # Ensure the project is set correctly
+            "stdout": str(stdout_dir),
+            "stderr": str(stderr_dir),
+        },
+        command_template=(
+            f"env NUMBA_CACHE_DIR={numba_cache_dir} "
+            "python "
+            "/mnt/share/homes/mfiking/github_repos/malaria_dengv/src/malaria_dengv/raking/raking_child.py "
+            "--cause {cause} "
+            "--scenario {scenario} "
+            "--measure {measure} "
+            "--draws {draws} "
+            "--n-workers {n_workers} "
+            "--write-batch-size {write_batch_size}"
+        ),
+        node_args=["cause", "scenario", "measure"],  # 👈 One task per cause/scenario/measure
+        task_args=["draws", "n_workers", "write_batch_size"],  # Draw batch raked by each task
+        op_args=[],
+    )
+
+
+    tasks = []
+    for cause in CAUSES:
+        for scenario in SCENARIOS:
+            for measure in MEASURES:
+                # Skip draws that already have an output
+                missing_draws = [
+                    draw for draw in DRAWS
+                    if not check_if_path_draw_exists(cause, scenario, measure, draw)
+                ]
+                if not missing_draws:
+                    continue
 
-    if output_name.exists():
-        return True
-    return False
-
-
-tasks = []
-for cause in CAUSES:
-    for scenario in SCENARIOS:
-        for measure in MEASURES:
-            for draw in DRAWS:
                 task = task_template.create_task(
                     cause=cause,
                     scenario=scenario,
                     measure=measure,
-                    draw=draw
+                    draws=format_draws(missing_draws),
+                    n_workers=N_WORKERS,
+                    write_batch_size=WRITE_BATCH_SIZE
                 )
                 tasks.append(task)
 
-print(f"Number of tasks to run: {len(tasks)}")
-
-if tasks:
-    workflow.add_tasks(tasks)
-    print("✅ Tasks successfully added to workflow.")
-else:
-    print("⚠️ No tasks added to workflow. Check task generation.")
-
-try:
-    workflow.bind()
-    print("✅ Workflow successfully bound.")
-    print(f"Running workflow with ID {workflow.workflow_id}.")
-    print("For full information see the Jobmon GUI:")
-    print(f"https://jobmon-gui.ihme.washington.edu/#/workflow/{workflow.workflow_id}")
-except Exception as e:
-    print(f"❌ Workflow binding failed: {e}")
-
-try:
-    status = workflow.run()
-    print(f"Workflow {workflow.workflow_id} completed with status {status}.")
-except Exception as e:
-    print(f"❌ Workflow submission failed: {e}")
+    print(f"Number of tasks to run: {len(tasks)}")
+
+    if tasks:
+        workflow.add_tasks(tasks)
+        print("✅ Tasks successfully added to workflow.")
+    else:
+        print("⚠️ No tasks added to workflow. Check task generation.")
+
+    try:
+        workflow.bind()
+        print("✅ Workflow successfully bound.")
+        print(f"Running workflow with ID {workflow.workflow_id}.")
+        print("For full information see the Jobmon GUI:")
+        print(f"https://jobmon-gui.ihme.washington.edu/#/workflow/{workflow.workflow_id}")
+    except Exception as e:
+        print(f"❌ Workflow binding failed: {e}")
+
+    try:
+        status = workflow.run()
+        print(f"Workflow {workflow.workflow_id} completed with status {status}.")
+    except Exception as e:
+        print(f"❌ Workflow submission failed: {e}")
+
+
+if __name__ == "__main__":
+    main()
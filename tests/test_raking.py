@@ -0,0 +1,450 @@
+from pathlib import Path
+
+import numba  # type: ignore[import-untyped]
+import numpy as np
+import pytest
+import xarray as xr
+
+from malaria_dengv.raking import raking_child, raking_launcher
+from malaria_dengv.raking.raking_child import (
+    _init_worker,
+    _rake_draw_batch,
+    check_layout_locations,
+    get_output_path,
+    impute_location_ids,
+    load_draws,
+    load_in_hierarchy_dataset,
+    main_raking_function,
+    parse_draws,
+    prepare_raking_layout,
+    rake_admin2_to_admin1,
+    rake_draw,
+    remap_imputed_location_ids,
+    save_raked_dataset_optimized,
+    select_draw,
+    subset_admin1_to_admin2_dims,
+)
+from malaria_dengv.raking.raking_launcher import (
+    check_if_path_draw_exists,
+    format_draws,
+    list_existing_outputs,
+)
+
+ADMIN2_IDS = np.array([101, 102, 103, 201, 202, 301, 302, 401])
+PARENT_IDS = np.array([1, 1, 1, 2, 2, 3, 3, 4])
+ADMIN1_IDS = np.array([1, 2, 3])
+
+
+def reference_rake(
+    admin2: xr.DataArray, admin1: xr.DataArray, parent_ids: np.ndarray
+) -> xr.DataArray:
+    # The groupby/where/broadcast formula the raking kernel replaced
+    admin2 = admin2.assign_coords(parent_id=("location_id", parent_ids))
+    admin2_sums = admin2.groupby("parent_id").sum(dim="location_id")
+    admin2_sums = admin2_sums.rename({"parent_id": "location_id"}).reindex(
+        location_id=admin1["location_id"].values
+    )
+    factor = (admin1 / admin2_sums.where(admin2_sums != 0, 1)).where(
+        (admin2_sums != 0) & (admin1 != 0), 1.0
+    )
+    factor = factor.rename({"location_id": "parent_id"}).sel(
+        parent_id=admin2["parent_id"]
+    )
+    return (admin2 * factor).drop_vars("parent_id")
+
+
+def make_datasets(dtype: type[np.floating]) -> tuple[xr.Dataset, xr.Dataset]:
+    rng = np.random.default_rng(0)
+    years = [2030, 2040]
+    sexes = [1, 2]
+
+    admin2 = rng.uniform(1, 10, size=(len(years), ADMIN2_IDS.size, len(sexes)))
+    admin1 = rng.uniform(10, 100, size=(len(sexes), ADMIN1_IDS.size, len(years)))
+
+    # All admin2 values of parent 2 are zero
+    admin2[0, 3:5, 0] = 0
+    # Admin1 value of parent 3 is zero
+    admin1[0, 2, 1] = 0
+    # Missing admin2 values, skipped in the parent sums
+    admin2[1, 0, 1] = np.nan
+    admin2[0, 6, 1] = np.nan
+    # Missing admin1 values
+    admin1[1, 0, 0] = np.nan
+    admin1[0, 1, 0] = np.nan
+
+    ds_admin2 = xr.Dataset(
+        {"value": (("year_id", "location_id", "sex_id"), admin2.astype(dtype))},
+        coords={"year_id": years, "location_id": ADMIN2_IDS, "sex_id": sexes},
+    )
+    # Different dim order than admin2
+    ds_admin1 = xr.Dataset(
+        {"value": (("sex_id", "location_id", "year_id"), admin1.astype(dtype))},
+        coords={"sex_id": sexes, "location_id": ADMIN1_IDS, "year_id": years},
+    )
+    return ds_admin2, ds_admin1
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_rake_admin2_to_admin1_matches_reference(dtype: type[np.floating]) -> None:
+    ds_admin2, ds_admin1 = make_datasets(dtype)
+    hierarchy_ds = xr.Dataset(
+        coords={"location_id": ADMIN2_IDS, "parent_id": ("location_id", PARENT_IDS)},
+    )
+
+    parent_idx, parent_ids, raked_ids, unraked_ids = prepare_raking_layout(
+        hierarchy_ds, ds_admin2["location_id"].values, ds_admin1["location_id"].values
+    )
+    np.testing.assert_array_equal(parent_ids, ADMIN1_IDS)
+    np.testing.assert_array_equal(unraked_ids, [401])
+
+    ds_admin2 = ds_admin2.sel(location_id=raked_ids)
+    ds_admin1 = ds_admin1.sel(location_id=parent_ids)
+    raked = rake_admin2_to_admin1(ds_admin2, ds_admin1, parent_idx)
+    expected = reference_rake(ds_admin2["value"], ds_admin1["value"], PARENT_IDS[:-1])
+
+    assert raked.dtype == dtype
+    assert raked.dims == ds_admin2["value"].dims
+    rtol = 1e-5 if dtype == np.float32 else 1e-12
+    xr.testing.assert_allclose(raked, expected.transpose(*raked.dims), rtol=rtol)
+
+
+def test_remap_imputed_location_ids() -> None:
+    loc_ids = np.array([1, 60908, 95069, 94364, 44858])
+    remapped = remap_imputed_location_ids(loc_ids)
+
+    np.testing.assert_array_equal(remapped, [1, 44858, 44858, 44858, 44858])
+    np.testing.assert_array_equal(loc_ids, [1, 60908, 95069, 94364, 44858])
+
+
+@pytest.mark.parametrize(
+    ("loc_ids", "kept_population"),
+    [
+        ([10, 60908, 44858, 95069], [1.0, 3.0]),
+        ([10, 95069, 60908], [1.0, 2.0]),
+    ],
+)
+def test_impute_location_ids(loc_ids: list[int], kept_population: list[float]) -> None:
+    ds = xr.Dataset(
+        {
+            "value": (
+                ("year_id", "location_id"),
+                np.arange(2 * len(loc_ids), dtype=float).reshape(2, -1),
+            ),
+            "population": ("location_id", np.arange(1, len(loc_ids) + 1, dtype=float)),
+        },
+        coords={"year_id": [2030, 2040], "location_id": loc_ids},
+    )
+    imputed = impute_location_ids(ds)
+
+    np.testing.assert_array_equal(imputed["location_id"], [10, 44858])
+    np.testing.assert_array_equal(
+        imputed["value"].sel(location_id=10), ds["value"].sel(location_id=10)
+    )
+    np.testing.assert_array_equal(
+        imputed["value"].sel(location_id=44858),
+        ds["value"].sel(location_id=loc_ids[1:]).sum("location_id"),
+    )
+    # Other location_id variables are kept, not dropped
+    np.testing.assert_array_equal(imputed["population"], kept_population)
+
+
+def test_impute_location_ids_without_old_ids() -> None:
+    ds = xr.Dataset(
+        {"value": ("location_id", [1.0, 2.0])}, coords={"location_id": [10, 44858]}
+    )
+    assert impute_location_ids(ds) is ds
+
+
+@pytest.mark.parametrize(
+    ("spec", "draws"),
+    [
+        ("7", [7]),
+        ("0-3", [0, 1, 2, 3]),
+        ("0,5,10-12", [0, 5, 10, 11, 12]),
+    ],
+)
+def test_parse_draws(spec: str, draws: list[int]) -> None:
+    assert parse_draws(spec) == draws
+
+
+@pytest.mark.parametrize(
+    ("draws", "spec"),
+    [
+        ([3], "3"),
+        (list(range(100)), "0-99"),
+        ([0, 1, 2, 5, 7, 8], "0-2,5,7-8"),
+    ],
+)
+def test_format_draws(draws: list[int], spec: str) -> None:
+    assert format_draws(draws) == spec
+    assert parse_draws(spec) == draws
+
+
+# Admin 1 forecast dim order, which the raked outputs keep
+DIMS = ("draw", "location_id", "age_group_id", "sex_id", "year_id", "scenario")
+# 60908 is imputed into 44858, 401's parent is not in admin 1, 999 is not in the hierarchy
+PIPELINE_ADMIN2_IDS = [101, 102, 44858, 60908, 201, 202, 401, 999]
+HIERARCHY = xr.Dataset(
+    coords={
+        "location_id": [101, 102, 44858, 201, 202, 401, 555],
+        "parent_id": ("location_id", [1, 1, 1, 2, 2, 4, 3]),
+    },
+)
+
+
+def make_admin1() -> xr.Dataset:
+    rng = np.random.default_rng(1)
+    coords = {
+        "draw": [0, 1, 2],
+        "location_id": [1, 2, 3, 9],
+        "age_group_id": [1, 2, 3],
+        "sex_id": [1, 2],
+        "year_id": [2030, 2040],
+        "scenario": [0],
+    }
+    shape = tuple(len(coords[dim]) for dim in DIMS)
+    return xr.Dataset(
+        {"value": (DIMS, rng.uniform(10, 100, size=shape).astype("float32"))},
+        coords=coords,
+    )
+
+
+def make_admin2(draw: int) -> xr.Dataset:
+    # Same layout as get_predicted_ds: draw and scenario first, one age group fewer than admin 1
+    rng = np.random.default_rng(draw)
+    dims = ("scenario", "draw", "location_id", "year_id", "age_group_id", "sex_id")
+    coords = {
+        "scenario": [0],
+        "draw": [draw],
+        "location_id": PIPELINE_ADMIN2_IDS,
+        "year_id": [2030, 2040],
+        "age_group_id": [1, 2],
+        "sex_id": [1, 2],
+    }
+    shape = tuple(len(coords[dim]) for dim in dims)
+    return xr.Dataset(
+        {
+            "value": (dims, rng.uniform(1, 10, size=shape).astype("float32")),
+            "population": (
+                "location_id",
+                np.arange(len(PIPELINE_ADMIN2_IDS), dtype=float),
+            ),
+            "year_weight": ("year_id", [0.5, 1.5]),
+        },
+        coords=coords,
+    )
+
+
+def expected_raked_draw(draw: int) -> xr.DataArray:
+    ds_admin1 = select_draw(make_admin1(), draw)
+    ds_admin2 = impute_location_ids(make_admin2(draw)).transpose(*DIMS)
+
+    raked_ids = [101, 102, 201, 202, 44858]
+    raked = reference_rake(
+        ds_admin2["value"].sel(location_id=raked_ids),
+        ds_admin1["value"].sel(age_group_id=[1, 2]),
+        HIERARCHY["parent_id"].sel(location_id=raked_ids).values,
+    )
+    unraked = ds_admin2["value"].sel(location_id=[401])
+    return xr.concat([raked, unraked], dim="location_id").transpose(*DIMS)
+
+
+@pytest.fixture
+def output_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(raking_child, "OUTPUT_DIR", tmp_path / "output")
+    return tmp_path / "output"
+
+
+@pytest.fixture
+def cluster_inputs(monkeypatch: pytest.MonkeyPatch) -> None:
+    admin1 = make_admin1()
+
+    def get_forcasted_ds(
+        cause: str, scenario: int, measure: str, draw: int | None = None
+    ) -> xr.Dataset:
+        return admin1 if draw is None else select_draw(admin1, draw)
+
+    def get_predicted_ds(
+        cause: str, scenario: int, measure: str, draw: int
+    ) -> xr.Dataset:
+        return make_admin2(draw)
+
+    monkeypatch.setattr(raking_child, "get_forcasted_ds", get_forcasted_ds)
+    monkeypatch.setattr(raking_child, "get_predicted_ds", get_predicted_ds)
+    monkeypatch.setattr(raking_child, "load_in_hierarchy_dataset", lambda: HIERARCHY)
+
+
+def test_rake_draw_matches_reference() -> None:
+    ds_admin1 = select_draw(make_admin1(), 0)
+    ds_admin2 = impute_location_ids(make_admin2(0)).transpose(*DIMS)
+    ds_admin1 = subset_admin1_to_admin2_dims(ds_admin1, ds_admin2)
+    layout = prepare_raking_layout(
+        HIERARCHY, ds_admin2["location_id"].values, ds_admin1["location_id"].values
+    )
+
+    raked = rake_draw(ds_admin2, ds_admin1, layout)
+
+    assert list(raked.data_vars) == ["value"]
+    assert raked["value"].dims == DIMS
+    np.testing.assert_array_equal(raked["age_group_id"], [1, 2])
+    # Unraked 401 is kept, 999 (not in the hierarchy) and the imputed 60908 are not
+    assert sorted(raked["location_id"].values) == [101, 102, 201, 202, 401, 44858]
+    xr.testing.assert_allclose(
+        raked["value"], expected_raked_draw(0).sel(location_id=raked["location_id"])
+    )
+
+
+def test_check_layout_locations() -> None:
+    ds_admin1 = make_admin1()
+    layout = prepare_raking_layout(
+        HIERARCHY, make_admin2(0)["location_id"].values, ds_admin1["location_id"].values
+    )
+
+    # Locations outside the hierarchy may differ between draws
+    check_layout_locations(make_admin2(0).drop_sel(location_id=999), HIERARCHY, layout)
+
+    with pytest.raises(ValueError, match=r"missing \[401\], not in layout \[\]"):
+        check_layout_locations(
+            make_admin2(0).drop_sel(location_id=401), HIERARCHY, layout
+        )
+
+
+@pytest.mark.parametrize(("cause", "delayed"), [("malaria", False), ("dengue", True)])
+def test_save_raked_dataset_optimized(
+    output_dir: Path,
+    cause: str,
+    delayed: bool,  # noqa: FBT001
+) -> None:
+    ds = make_admin1()[["value"]].sel(draw=[0])
+    outfile = get_output_path(cause, 75, "death", 0)
+    assert outfile.is_relative_to(output_dir)
+
+    write = save_raked_dataset_optimized(cause, 75, "death", 0, ds, delayed=delayed)
+    if delayed:
+        assert not outfile.exists()
+        assert write is not None
+        write.compute()  # type: ignore[no-untyped-call]
+
+    # Only the finished file is left, no temporary file
+    assert list(outfile.parent.iterdir()) == [outfile]
+    assert outfile.stat().st_mode & 0o777 == 0o775  # noqa: PLR2004
+    with xr.open_dataset(outfile, engine="h5netcdf") as saved:
+        assert saved["value"].dtype == np.float32
+        xr.testing.assert_equal(saved["value"], ds["value"])
+
+
+@pytest.mark.usefixtures("cluster_inputs")
+def test_main_raking_function(output_dir: Path) -> None:
+    raked = main_raking_function("malaria", 0, "death", 1)
+
+    assert raked["value"].dims == DIMS
+    xr.testing.assert_allclose(
+        raked["value"], expected_raked_draw(1).sel(location_id=raked["location_id"])
+    )
+    with xr.open_dataset(
+        get_output_path("malaria", 0, "death", 1), engine="h5netcdf"
+    ) as saved:
+        xr.testing.assert_equal(saved["value"], raked["value"])
+
+
+@pytest.mark.usefixtures("cluster_inputs")
+@pytest.mark.parametrize("draws", [[0, 1], [2]])
+def test_rake_draw_batch(output_dir: Path, draws: list[int]) -> None:
+    admin1 = make_admin1()
+    layout = prepare_raking_layout(
+        HIERARCHY,
+        remap_imputed_location_ids(make_admin2(0)["location_id"].values),
+        admin1["location_id"].values,
+    )
+
+    assert (
+        _rake_draw_batch("dengue", 0, "yll", draws, "value", admin1, HIERARCHY, layout)
+        == draws
+    )
+
+    for draw in draws:
+        outfile = get_output_path("dengue", 0, "yll", draw)
+        with xr.open_dataset(outfile, engine="h5netcdf") as saved:
+            xr.testing.assert_allclose(
+                saved["value"],
+                expected_raked_draw(draw).sel(location_id=saved["location_id"]),
+            )
+
+
+def test_select_draw_along_other_dimension() -> None:
+    ds = xr.Dataset(
+        {"value": ("sample", [1.0, 2.0, 3.0])}, coords={"draw": ("sample", [5, 6, 7])}
+    )
+    selected = select_draw(ds, 6)
+
+    np.testing.assert_array_equal(selected["value"], [2.0])
+    np.testing.assert_array_equal(selected["draw"], [6])
+
+
+def test_load_in_hierarchy_dataset(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    hierarchy_file = tmp_path / "hierarchy.nc"
+    xr.Dataset(
+        {
+            "parent_id": ("location_id", [0, 1, 1, 2]),
+            "level": ("location_id", [3, 5, 5, 5]),
+        },
+        coords={"location_id": [1, 101, 102, 201]},
+    ).to_netcdf(hierarchy_file, engine="h5netcdf")
+    monkeypatch.setattr(raking_child, "HIERARCHY_FILE", hierarchy_file)
+    monkeypatch.setattr(
+        raking_child, "HIERARCHY_CACHE", tmp_path / "hierarchy_admin2.npz"
+    )
+
+    # The first call builds the cache, the second one reads it
+    for _ in range(2):
+        hierarchy_ds = load_in_hierarchy_dataset()
+        np.testing.assert_array_equal(hierarchy_ds["location_id"], [101, 102, 201])
+        np.testing.assert_array_equal(hierarchy_ds["parent_id"], [1, 1, 2])
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "hierarchy.nc",
+        "hierarchy_admin2.npz",
+    ]
+
+
+def test_load_draws(tmp_path: Path) -> None:
+    xr.Dataset({"val": ("location_id", [1.0, 2.0])}).to_netcdf(
+        tmp_path / "draw_7.nc", engine="h5netcdf"
+    )
+    xr.Dataset({"val": (("draw", "location_id"), [[3.0, 4.0]])}).to_netcdf(
+        tmp_path / "draw_8.nc", engine="h5netcdf"
+    )
+
+    ds = load_draws(tmp_path)
+    np.testing.assert_array_equal(ds["draw_id"], [7, 8])
+    np.testing.assert_array_equal(ds["val"], [[1.0, 2.0], [3.0, 4.0]])
+
+    (tmp_path / "mean.nc").touch()
+    with pytest.raises(ValueError, match=r"Could not parse draw_id from mean\.nc"):
+        load_draws(tmp_path)
+
+
+def test_init_worker() -> None:
+    n_threads = numba.get_num_threads()
+    _init_worker(1)
+    assert numba.get_num_threads() == 1
+    _init_worker(n_threads)
+
+
+def test_check_if_path_draw_exists(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(raking_launcher, "OUTPUT_DIR", tmp_path)
+    list_existing_outputs.cache_clear()
+    draw_dir = (
+        tmp_path
+        / "as_cause_malaria_measure_mortality_metric_count_ssp_scenario_ssp126_dah_scenario_Baseline_raked"
+    )
+    draw_dir.mkdir()
+    (draw_dir / "draw_0.nc").touch()
+
+    assert check_if_path_draw_exists("malaria", 75, "death", 0)
+    assert not check_if_path_draw_exists("malaria", 75, "death", 1)
+    assert not check_if_path_draw_exists("dengue", 75, "death", 0)
+    list_existing_outputs.cache_clear()